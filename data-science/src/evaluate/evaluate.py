@@ -6,13 +6,18 @@ Saves predictions, evaluation results and deploy flag.
 """
 
 import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 
-from sklearn.metrics import accuracy_score
+from sklearn.metrics import roc_auc_score
 
 import mlflow
 import mlflow.sklearn
@@ -30,6 +35,24 @@ FEATURE_COLS = [
     "debt_to_income_ratio"
 ]
 
+NUMERIC_COLS = [
+    "loan_amount", "loan_to_value_ratio", "loan_term", "property_value", "total_units",
+    "income", "debt_to_income_ratio"
+]
+
+# Categorical codes reach 8888 (e.g. "Sex Not Available"), so int16 is the narrowest safe type
+COLUMN_TYPES = {
+    TARGET_COL: pa.int8(),
+    **{col: pa.int16() for col in FEATURE_COLS if col not in NUMERIC_COLS},
+    **{col: pa.float32() for col in NUMERIC_COLS},
+}
+
+# ONNX export written next to the MLflow model by the train step
+ONNX_MODEL_FILE = "model.onnx"
+
+# 16384 rows x 22 float32 features is ~1.4 MB, about one L2 cache's worth per predict batch
+PREDICT_BATCH_ROWS = 16384
+
 def parse_args():
     '''Parse input arguments'''
 
@@ -38,48 +61,137 @@ def parse_args():
     parser.add_argument("--model_input", type=str, help="Path of input model")
     parser.add_argument("--test_data", type=str, help="Path to test dataset")
     parser.add_argument("--evaluation_output", type=str, help="Path of eval results")
+    parser.add_argument("--recompute_scores", type=str, default="false",
+                        help="Re-predict every registered version instead of reading its logged score")
 
     args = parser.parse_args()
 
     return args
 
-def main(args):
-    '''Read trained model and test dataset, evaluate model and save result'''
-
-    # Load the test data
-    test_data = pd.read_csv((Path(args.test_data) / "test.csv"), index_col=False)    
+class OnnxClassifier:
+    '''Scores an ONNX-exported classifier through the predict_proba/classes_ interface of the sklearn model'''
+
+    def __init__(self, onnx_path, n_jobs=-1):
+        # ONNX exports are opt-in at train time, so onnxruntime is only imported when one is scored
+        import onnxruntime as ort
+
+        self.onnx_path = onnx_path
+        session_options = ort.SessionOptions()
+        # 0 lets onnxruntime use one thread per core, matching n_jobs=-1
+        session_options.intra_op_num_threads = 0 if n_jobs == -1 else n_jobs
+        self.session = ort.InferenceSession(str(onnx_path), sess_options=session_options,
+                                            providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.probabilities_name = self.session.get_outputs()[-1].name
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.classes_ = np.array(json.loads(metadata["classes"]))
+        self.model_repr = metadata.get("model_repr", f"OnnxClassifier('{onnx_path}')")
+
+    def __repr__(self):
+        return self.model_repr
+
+    def predict_proba(self, X):
+        return self.session.run([self.probabilities_name], {self.input_name: X})[0]
+
+def load_model(model_path, prefer_onnx=False, n_jobs=-1):
+    '''Load a saved model directory; with prefer_onnx, use its ONNX export when there is one.
+    n_jobs sets the predict threads of the loaded model'''
+
+    onnx_path = Path(model_path) / ONNX_MODEL_FILE
+    if prefer_onnx and onnx_path.exists():
+        return OnnxClassifier(onnx_path, n_jobs)
+
+    model = mlflow.sklearn.load_model(model_path)
+    # the saved n_jobs (None in older versions) is replaced by the caller's choice
+    model.n_jobs = n_jobs
+    return model
+
+def read_test_data(test_data):
+    '''Read the feature and target columns of the test dataset'''
+
+    table = pacsv.read_csv(
+        str(Path(test_data) / "test.csv"),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=FEATURE_COLS + [TARGET_COL],
+            column_types=COLUMN_TYPES))
     #test_data = pd.read_parquet(Path(args.test_data))
     #test_data_mltable = mltable.load(Path(args.test_data))
     #test_data = test_data_mltable.to_pandas_dataframe()    
 
-    # Split the data into inputs and outputs
-    y_test = test_data[TARGET_COL]
-    X_test = test_data[FEATURE_COLS]
+    return table.to_pandas(zero_copy_only=False, self_destruct=True)
 
-    # Load the model from input port
-    model =  mlflow.sklearn.load_model(args.model_input) 
+def main(args):
+    '''Read trained model and test dataset, evaluate model and save result'''
+
+    # Load the test data and the model from input port; both are I/O-bound and
+    # independent, so overlap them
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        data_future = executor.submit(read_test_data, args.test_data)
+        # the current model is scored with the sklearn pickle that gets registered and deployed
+        model_future = executor.submit(load_model, args.model_input)
+        test_data = data_future.result()
+        model = model_future.result()
+
+    # Split the data into inputs and outputs
+    y_test = test_data.pop(TARGET_COL)
+    # convert once to the contiguous float32 layout the trees predict on,
+    # instead of paying the conversion on every predict call
+    X_test = np.ascontiguousarray(test_data.to_numpy(dtype=np.float32))
+    del test_data
 
     # ---------------- Model Evaluation ---------------- #
-    yhat_test, score = model_evaluation(X_test, y_test, model, args.evaluation_output)
+    yhat_test, probas_test, score = model_evaluation(X_test, y_test, model, args.evaluation_output)
 
     # ----------------- Model Promotion ---------------- #
-    predictions, deploy_flag = model_promotion(args.model_name, args.evaluation_output, X_test, y_test, yhat_test, score)
+    recompute_scores = args.recompute_scores.lower() in ("true", "1", "yes")
+    predictions, deploy_flag = model_promotion(args.model_name, args.evaluation_output, X_test, y_test, yhat_test, score,
+                                               recompute_scores)
 
+    metrics = {"test accuracy score": score, "deploy flag": int(deploy_flag)}
+    # AUC needs both classes in the test split and in the model; classes_ are sorted,
+    # so the last probability column is the approved (1) class
+    if probas_test.shape[1] == 2 and y_test.nunique() == 2:
+        metrics["test roc auc score"] = roc_auc_score(y_test, probas_test[:, -1])
 
+    # log evaluation and promotion metrics in a single request
+    mlflow.log_metrics(metrics)
+
+
+
+def fast_accuracy(y, yhat):
+    '''Fraction of correct predictions, skipping sklearn's input validation'''
+
+    return float(np.equal(np.asarray(y), np.asarray(yhat)).mean())
+
+def batched_predict(model, X, batch_rows=PREDICT_BATCH_ROWS):
+    '''Predict in row batches so each batch stays cache-resident while the trees walk it.
+    Returns the predicted labels together with the class probabilities they were taken from'''
+
+    if len(X) <= batch_rows:
+        probas = model.predict_proba(X)
+    else:
+        n_batches = -(-len(X) // batch_rows)
+        probas = np.concatenate([model.predict_proba(batch) for batch in np.array_split(X, n_batches)])
+
+    # predict() is the argmax of predict_proba(); taking it here avoids a second pass over the trees
+    return model.classes_.take(probas.argmax(axis=1)), probas
 
 def model_evaluation(X_test, y_test, model, evaluation_output):
 
     # Get predictions to y_test (y_test)
-    yhat_test = model.predict(X_test)
+    yhat_test, probas_test = batched_predict(model, X_test)
 
-    # Save the output data with feature columns, predicted cost, and actual cost in csv file
-    output_data = X_test.copy()
-    output_data["real_label"] = y_test
-    output_data["predicted_label"] = yhat_test
-    output_data.to_csv((Path(evaluation_output) / "predictions.csv"))
+    # Save the output data with feature columns, predicted label, and actual label as zstd-compressed parquet
+    output_data = (
+        pa.Table.from_pandas(pd.DataFrame(X_test, columns=FEATURE_COLS), preserve_index=False)
+        .append_column("real_label", pa.array(y_test.to_numpy()))
+        .append_column("predicted_label", pa.array(yhat_test))
+    )
+    pq.write_table(output_data, str(Path(evaluation_output) / "predictions.parquet"),
+                   compression="zstd", row_group_size=65536)
 
     # Evaluate Model performance with the test set
-    accuracy = accuracy_score(y_test, yhat_test)
+    accuracy = fast_accuracy(y_test, yhat_test)
 
     # Print score report to a text file
     (Path(evaluation_output) / "score.txt").write_text(
@@ -88,24 +200,62 @@ def model_evaluation(X_test, y_test, model, evaluation_output):
     with open((Path(evaluation_output) / "score.txt"), "a") as outfile:
         outfile.write("Accuracy: {accuracy.2f} \n")
 
-    mlflow.log_metric("test accuracy score", accuracy)
+    # register step tags the registered version with this, so promotion can read it back
+    with open((Path(evaluation_output) / "test_accuracy"), 'w') as outfile:
+        outfile.write(f"{accuracy}")
+
+    return yhat_test, probas_test, accuracy
+
+def load_registered_model(model_uri):
+    '''Download a registered model version and load it'''
+
+    # re-scoring only compares versions, so the faster ONNX export is used where it exists;
+    # versions are scored in parallel by the promotion pool, so each one predicts single-threaded
+    return load_model(mlflow.artifacts.download_artifacts(artifact_uri=model_uri), prefer_onnx=True, n_jobs=1)
+
+def score_version(model_name, model_version, X_unique, inverse, y_test):
+    '''Load a registered model version and score it on the test set, given as its unique rows
+    and the index of each test row into them'''
+
+    mdl = load_registered_model(f"models:/{model_name}/{model_version}")
+    yhat_unique, _ = batched_predict(mdl, X_unique)
+    yhat = yhat_unique[inverse]
 
-    return yhat_test, accuracy
+    return f"{model_name}:{model_version}", yhat, fast_accuracy(y_test, yhat)
 
-def model_promotion(model_name, evaluation_output, X_test, y_test, yhat_test, score):
+def model_promotion(model_name, evaluation_output, X_test, y_test, yhat_test, score, recompute_scores=False):
     
     scores = {}
     predictions = {}
 
     client = MlflowClient()
 
+    versions = []
     for model_run in client.search_model_versions(f"name='{model_name}'"):
-        model_version = model_run.version
-        mdl = mlflow.sklearn.load_model(
-            model_uri=f"models:/{model_name}/{model_version}")
-        predictions[f"{model_name}:{model_version}"] = mdl.predict(X_test)
-        scores[f"{model_name}:{model_version}"] = accuracy_score(
-            y_test, predictions[f"{model_name}:{model_version}"])
+        key = f"{model_name}:{model_run.version}"
+        if not recompute_scores:
+            # the register step tags each version with its test score, so the registry listing
+            # already carries it; untagged versions predate the tag and are re-predicted
+            tagged_score = model_run.tags.get("test accuracy score")
+            if tagged_score is not None:
+                scores[key] = float(tagged_score)
+                continue
+        # versions without a logged score are always re-predicted so none escapes the comparison
+        versions.append(model_run.version)
+
+    # model downloads are I/O-bound and predict releases the GIL, so score versions concurrently
+    if versions:
+        # predict each distinct feature row once per version and gather back to the full test set
+        X_unique, inverse = np.unique(X_test, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        # one single-threaded version per core keeps the pool from oversubscribing the CPU
+        with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, len(versions))) as executor:
+            futures = [executor.submit(score_version, model_name, model_version, X_unique, inverse, y_test)
+                       for model_version in versions]
+            for future in futures:
+                key, yhat, accuracy = future.result()
+                predictions[key] = yhat
+                scores[key] = accuracy
 
     if scores:
         if score >= max(list(scores.values())):
@@ -121,9 +271,8 @@ def model_promotion(model_name, evaluation_output, X_test, y_test, yhat_test, sc
 
     # add current model score and predictions
     scores["current model"] = score
-    predictions["currrent model"] = yhat_test
+    predictions["current model"] = yhat_test
 
-    mlflow.log_metric("deploy flag", bool(deploy_flag))
     print("deploy flag", deploy_flag)
 
     return predictions, deploy_flag
@@ -139,6 +288,7 @@ if __name__ == "__main__":
         f"Model path: {args.model_input}",
         f"Test data path: {args.test_data}",
         f"Evaluation output path: {args.evaluation_output}",
+        f"Recompute scores: {args.recompute_scores}",
     ]
 
     for line in lines:
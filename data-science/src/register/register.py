@@ -8,6 +8,7 @@ import argparse
 from pathlib import Path
 import pickle
 import mlflow
+from mlflow.tracking import MlflowClient
 
 import os 
 import json
@@ -22,6 +23,8 @@ def parse_args():
     parser.add_argument(
         "--model_info_output_path", type=str, help="Path to write model info JSON"
     )
+    parser.add_argument('--relog_conda_env', type=str, default='false',
+                        help='Reload the model and re-log it with the pinned conda env instead of uploading it as saved')
     args, _ = parser.parse_known_args()
     print(f'Arguments: {args}')
 
@@ -35,60 +38,73 @@ def main(args):
         deploy_flag = int(infile.read())
         
     mlflow.log_metric("deploy flag", int(deploy_flag))
+
+    # test score from the evaluate step, tagged on the registered version below
+    test_accuracy_path = Path(args.evaluation_output) / "test_accuracy"
+    test_accuracy = float(test_accuracy_path.read_text()) if test_accuracy_path.exists() else None
     deploy_flag=1
     if deploy_flag==1:
 
         print("Registering ", args.model_name)
 
-        # load model
-        model = mlflow.sklearn.load_model(args.model_path)
-
-        conda_env = {
-            "name": "mlflow-env",
-            "channels": ["conda-forge"],
-            "dependencies": [
-                "python=3.8",
-                {
-                    "pip": [
-                        "scikit-learn==1.2.2",
-                        'cloudpickle==2.2.1',
-                        'numpy==1.24.4',
-                        'packaging==23.2',
-                        'psutil==5.9.6',
-                        'pyyaml==6.0.1',
-                        'scipy==1.10.1',
-                        'mlflow'                                               
-                        ],
-                    },
-                ],
-            }
-
-        #conda_env = {
-        #    'channels': ['conda-forge'],
-        #    'dependencies': [
-        #       'python=3.8.18',
-        #        'pip'],
-        #        'pip': [
-        #            'mlflow',
-        #            'scikit-learn==1.2.2',
-        #            'cloudpickle==2.2.1',
-        #            'numpy==1.24.4',
-        #            'packaging==23.2',
-        #            'psutil==5.9.6',
-        #            'pyyaml==6.0.1',
-        #            'scipy==1.10.1'
-        #            ],
-        #            'name': 'mlflow-env'
-        #            } 
-
-        # log model using mlflow
-        mlflow.sklearn.log_model(model, args.model_name, conda_env=conda_env)
+        relog_conda_env = args.relog_conda_env.lower() in ("true", "1", "yes")
+        if relog_conda_env:
+            # load model
+            model = mlflow.sklearn.load_model(args.model_path)
+
+            conda_env = {
+                "name": "mlflow-env",
+                "channels": ["conda-forge"],
+                "dependencies": [
+                    "python=3.8",
+                    {
+                        "pip": [
+                            "scikit-learn==1.2.2",
+                            'cloudpickle==2.2.1',
+                            'numpy==1.24.4',
+                            'packaging==23.2',
+                            'psutil==5.9.6',
+                            'pyyaml==6.0.1',
+                            'scipy==1.10.1',
+                            'mlflow'                                               
+                            ],
+                        },
+                    ],
+                }
+
+            #conda_env = {
+            #    'channels': ['conda-forge'],
+            #    'dependencies': [
+            #       'python=3.8.18',
+            #        'pip'],
+            #        'pip': [
+            #            'mlflow',
+            #            'scikit-learn==1.2.2',
+            #            'cloudpickle==2.2.1',
+            #            'numpy==1.24.4',
+            #            'packaging==23.2',
+            #            'psutil==5.9.6',
+            #            'pyyaml==6.0.1',
+            #            'scipy==1.10.1'
+            #            ],
+            #            'name': 'mlflow-env'
+            #            } 
+
+            # log model using mlflow
+            mlflow.sklearn.log_model(model, args.model_name, conda_env=conda_env)
+        else:
+            # the train step already saved an MLflow model; upload its files as-is instead of
+            # unpickling and re-pickling the whole forest just to log it again
+            mlflow.log_artifacts(args.model_path, artifact_path=args.model_name)
 
         # register logged model using mlflow
         run_id = mlflow.active_run().info.run_id
         model_uri = f'runs:/{run_id}/{args.model_name}'
         mlflow_model = mlflow.register_model(model_uri, args.model_name)
         model_version = mlflow_model.version
+        # tag the version with its score so promotion reads it straight from the registry listing
+        if test_accuracy is not None:
+            MlflowClient().set_model_version_tag(args.model_name, model_version, "test accuracy score", test_accuracy)
 
         # write model info
         print("Writing JSON")
@@ -113,6 +129,7 @@ if __name__ == "__main__":
         f"Model name: {args.model_name}",
         f"Model path: {args.model_path}",
         f"Evaluation output path: {args.evaluation_output}",
+        f"Re-log with conda env: {args.relog_conda_env}",
     ]
 
     for line in lines:
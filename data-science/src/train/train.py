@@ -1,13 +1,13 @@
 import argparse
+import json
 
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
-from matplotlib import pyplot as plt
+import pyarrow as pa
+import pyarrow.csv as pacsv
 
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import accuracy_score
+from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
 
 import mlflow
 import mlflow.sklearn
@@ -23,12 +23,34 @@ FEATURE_COLS = [
     "debt_to_income_ratio"
 ]
 
+NUMERIC_COLS = [
+    "loan_amount", "loan_to_value_ratio", "loan_term", "property_value", "total_units",
+    "income", "debt_to_income_ratio"
+]
+
+# Categorical codes reach 8888 (e.g. "Sex Not Available"), so int16 is the narrowest safe type
+COLUMN_TYPES = {
+    TARGET_COL: pa.int8(),
+    **{col: pa.int16() for col in FEATURE_COLS if col not in NUMERIC_COLS},
+    **{col: pa.float32() for col in NUMERIC_COLS},
+}
+
+# ONNX export written next to the MLflow model, used by evaluation for predict
+ONNX_MODEL_FILE = "model.onnx"
+# rows and tolerance for checking the ONNX export against sklearn predict_proba
+ONNX_PARITY_ROWS = 10000
+ONNX_PARITY_ATOL = 1e-4
+
 def parse_args():
     '''Parse input arguments'''
 
     parser = argparse.ArgumentParser("train")
     parser.add_argument("--train_data", type=str, help="Path to train dataset")
     parser.add_argument("--model_output", type=str, help="Path of output model")
+    parser.add_argument("--algo", type=str, choices=["rf", "hgb", "cuml_rf"], default="rf",
+                        help="Classifier: sklearn random forest, histogram gradient boosting, or cuML GPU random forest")
+    parser.add_argument("--export_onnx", type=str, default="false",
+                        help="Also save an ONNX export of the model, used when evaluation re-scores registered versions")
 
     # classifier specific arguments
     parser.add_argument('--regressor__n_estimators', type=int, default=100,
@@ -47,37 +69,105 @@ def parse_args():
     args = parser.parse_args()
 
     return args
-    
+
+def fast_accuracy(y, yhat):
+    '''Fraction of correct predictions, skipping sklearn's input validation'''
+
+    return float(np.equal(np.asarray(y), np.asarray(yhat)).mean())
+
+def save_onnx_model(model, X, model_output):
+    '''Export the fitted classifier to ONNX inside the saved model directory, if the export
+    reproduces the sklearn probabilities on X'''
+
+    # the export is opt-in, so its dependencies are only imported when it runs
+    import onnxruntime as ort
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+
+    onx = convert_sklearn(model,
+                          initial_types=[("X", FloatTensorType([None, len(FEATURE_COLS)]))],
+                          options={id(model): {"zipmap": False}})
+    # evaluation maps argmax indices back to labels with these, like sklearn's classes_,
+    # and reports the estimator with its hyperparameters in the score report
+    onx.metadata_props.add(key="classes", value=json.dumps(model.classes_.tolist()))
+    onx.metadata_props.add(key="model_repr", value=repr(model))
+
+    # the ONNX tree ensemble compares against float32 thresholds where sklearn keeps float64,
+    # which can flip splits on continuous features; only ship the export if it agrees with sklearn
+    sample = X[:ONNX_PARITY_ROWS]
+    session = ort.InferenceSession(onx.SerializeToString(), providers=["CPUExecutionProvider"])
+    onnx_probas = session.run([session.get_outputs()[-1].name], {session.get_inputs()[0].name: sample})[0]
+    sklearn_probas = model.predict_proba(sample)
+    if not (np.array_equal(onnx_probas.argmax(axis=1), sklearn_probas.argmax(axis=1))
+            and np.allclose(onnx_probas, sklearn_probas, atol=ONNX_PARITY_ATOL)):
+        print("ONNX export does not match sklearn predict_proba; model.onnx not written")
+        return
+
+    (Path(model_output) / ONNX_MODEL_FILE).write_bytes(onx.SerializeToString())
+
+def build_model(args):
+    '''Create the classifier selected by --algo.
+    Returns the classifier and the hyperparameters it was constructed with'''
+
+    if args.algo == "hgb":
+        # min_samples_leaf keeps HistGradientBoosting's own default (20); the RF default of 1 overfits boosting
+        params = {"max_iter": args.regressor__n_estimators,
+                  "max_depth": args.regressor__max_depth or 8,
+                  "early_stopping": True}
+        return HistGradientBoostingClassifier(**params), params
+
+    if args.algo == "cuml_rf":
+        # cuML is only present on GPU compute, so import it on demand
+        from cuml.ensemble import RandomForestClassifier as cuRF
+        params = {"n_estimators": args.regressor__n_estimators,
+                  "bootstrap": bool(args.regressor__bootstrap),
+                  "max_depth": args.regressor__max_depth or 16,
+                  "max_features": args.regressor__max_features,
+                  "min_samples_leaf": args.regressor__min_samples_leaf,
+                  "min_samples_split": args.regressor__min_samples_split,
+                  "n_streams": 4}
+        return cuRF(**params, output_type="numpy"), params
+
+    params = {"n_estimators": args.regressor__n_estimators,
+              "bootstrap": args.regressor__bootstrap,
+              "max_depth": args.regressor__max_depth,
+              "max_features": args.regressor__max_features,
+              "min_samples_leaf": args.regressor__min_samples_leaf,
+              "min_samples_split": args.regressor__min_samples_split}
+    return RandomForestClassifier(**params, random_state=None, n_jobs=-1), params
+
 def main(args):
     '''Read train dataset, train model, save trained model'''
 
     # Read train data
-    train_data = pd.read_csv((Path(args.train_data) / "train.csv"), index_col=False)    
+    table = pacsv.read_csv(
+        str(Path(args.train_data) / "train.csv"),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=FEATURE_COLS + [TARGET_COL],
+            column_types=COLUMN_TYPES))
+    train_data = table.to_pandas(zero_copy_only=False, self_destruct=True)
+    del table
     #train_data = pd.read_parquet(Path(args.train_data))
     #train_data_mltable = mltable.load(Path(args.train_data))
     #train_data = train_data_mltable.to_pandas_dataframe()
 
     # Split the data into input(X) and output(y)
-    y_train = train_data[TARGET_COL]
-    X_train = train_data[FEATURE_COLS]
+    y_train = train_data.pop(TARGET_COL)
+    # the reader already narrowed features to int16/float32; the trees split on float32,
+    # so hand them a contiguous float32 array and skip sklearn's internal copy
+    X_train = np.ascontiguousarray(train_data.to_numpy(dtype=np.float32))
+    del train_data
 
-    # Train a Random Forest Regression Model with the training set
-    model = RandomForestClassifier(n_estimators = args.regressor__n_estimators,
-                                  bootstrap = args.regressor__bootstrap,
-                                  max_depth = args.regressor__max_depth,
-                                  max_features = args.regressor__max_features,
-                                  min_samples_leaf = args.regressor__min_samples_leaf,
-                                  min_samples_split = args.regressor__min_samples_split,
-                                  random_state=None)
+    if args.algo == "cuml_rf":
+        import cudf
+        X_train = cudf.DataFrame(X_train)
+        y_train = cudf.Series(y_train.astype(np.int32))
 
-    # log model hyperparameters
-    mlflow.log_param("model", "RandomForestClassifier")
-    mlflow.log_param("n_estimators", args.regressor__n_estimators)
-    mlflow.log_param("bootstrap", args.regressor__bootstrap)
-    mlflow.log_param("max_depth", args.regressor__max_depth)
-    mlflow.log_param("max_features", args.regressor__max_features)
-    mlflow.log_param("min_samples_leaf", args.regressor__min_samples_leaf)
-    mlflow.log_param("min_samples_split", args.regressor__min_samples_split)
+    # Train the selected classifier with the training set
+    model, params = build_model(args)
+
+    # log the hyperparameters the selected classifier was actually built with
+    mlflow.log_params({"model": type(model).__name__, "algo": args.algo, **params})
 
     # Train model with the train set
     model.fit(X_train, y_train)
@@ -86,14 +176,19 @@ def main(args):
     yhat_train = model.predict(X_train)
 
     # Evaluate Regression performance with the train set
-    accuracy = accuracy_score(y_train, yhat_train)
+    if args.algo == "cuml_rf":
+        y_train = y_train.to_numpy()
+    accuracy = fast_accuracy(y_train, yhat_train)
     
     # log model performance metrics
-    mlflow.log_metric("train accuracy score", accuracy)
+    mlflow.log_metrics({"train accuracy score": accuracy})
     print("train accuracy score ", accuracy)
 
     # Save the model
     mlflow.sklearn.save_model(sk_model=model, path=args.model_output)
+    export_onnx = args.export_onnx.lower() in ("true", "1", "yes")
+    if export_onnx and args.algo != "cuml_rf":
+        save_onnx_model(model, X_train, args.model_output)
 
 
 if __name__ == "__main__":
@@ -108,6 +203,8 @@ if __name__ == "__main__":
     lines = [
         f"Train dataset input path: {args.train_data}",
         f"Model output path: {args.model_output}",
+        f"algo: {args.algo}",
+        f"export_onnx: {args.export_onnx}",
         f"n_estimators: {args.regressor__n_estimators}",
         f"bootstrap: {args.regressor__bootstrap}",
         f"max_depth: {args.regressor__max_depth}",